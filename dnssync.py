@@ -9,6 +9,9 @@ Options: --remove|-r    remove records in target not found in source
          --mail|-m MAIL override email address in SOA records
          --quiet|-q     don't output statistics
          --verbose|-v   progress output
+         --jobs|-j N    number of zones to sync in parallel
+         --requests|-R N max. number of record changes in flight
+         --skip-unchanged|-s skip zones whose source serial did not change
 
 dnssync.py looks at all records from ZONE1 (and ZONE2 if specified or all
 zones with --all) in CLOUD1 and analyzes all records. It then looks at the
@@ -28,24 +31,83 @@ NS records for further zones (subdomains) are analyzed -- if they point to
 a third party DNS, they are copied over. If they point to the DNS NS of either
 source or target cloud, they are ignored.
 
+With --skip-unchanged, the serial of each successfully synced source zone
+is remembered in ~/.cache/dnssync/serials.json (per source/target cloud
+pair) and zones whose serial is unchanged are skipped on the next run.
+Changes done directly in the target cloud are not noticed then. This is
+not done with --remove.
+
 (c) Kurt Garloff <scs@garloff.de>, 2/2024
 SPDX-License-Identifier: CC-BY-SA-4.0
 """
 
-# import os
+import os
 import sys
+import json
 import argparse
-import openstack
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, fields
+# openstack (and keystoneauth1) are imported where needed, keeping --help fast
+
+
+# Page size for listing zones and recordsets (Designate's default max_limit_v2)
+PAGE_SIZE = 1000
+
+# Record types never copied (SOA is created with the zone)
+SKIP_TYPES = frozenset({'SOA'})
+
+# Serialize output from zones synced in parallel
+out_lock = threading.Lock()
+
+# Min. time between two progress updates (s)
+PROGRESS_INTERVAL = 0.1
 
 
-# Globals
-nodom = 0
-nodomcreate = 0
-noreccreate = 0
-norecskip   = 0
-norecchange = 0
-norecnochg  = 0
-norecdelete = 0
+@dataclass
+class Stats:
+    "Statistics counters, summed up over all zones"
+    nodom: int = 0
+    nodomcreate: int = 0
+    noreccreate: int = 0
+    norecskip: int = 0
+    norecchange: int = 0
+    norecnochg: int = 0
+    norecdelete: int = 0
+    errs: int = 0
+
+    def __iadd__(self, other):
+        for fld in fields(self):
+            setattr(self, fld.name, getattr(self, fld.name) + getattr(other, fld.name))
+        return self
+
+    def report(self):
+        "Output statistics"
+        print(f"Statistics: {self.nodom} domains processed, {self.nodomcreate} domains created")
+        print(f"            {self.noreccreate} records created, {self.norecdelete} records deleted")
+        print(f"            {self.norecchange} records changed, {self.norecnochg} records unchanged, {self.norecskip} records skipped")
+        print(f"{self.errs} errors")
+
+
+def out(*args, **kwargs):
+    "print() that does not interleave with other threads"
+    with out_lock:
+        print(*args, **kwargs)
+
+
+def progress(msg, last):
+    """Overwrite the current line with msg, unless the last update
+       (at monotonic time last) was less than PROGRESS_INTERVAL ago.
+       Returns the time of the last update.
+    """
+    now = time.monotonic()
+    if now - last < PROGRESS_INTERVAL:
+        return last
+    with out_lock:
+        sys.stdout.write(f"\r{msg}                    ")
+        sys.stdout.flush()
+    return now
 
 
 def usage():
@@ -54,8 +116,8 @@ def usage():
     sys.exit(1)
 
 
-def setup_parser():
-    "Setup argument parser"
+def _build_parser():
+    "Build argument parser"
     parser = argparse.ArgumentParser(prog='dnssync.py',
                                      description='sync designate zones')
     parser.add_argument('-r', '--remove', action='store_true',
@@ -70,6 +132,12 @@ def setup_parser():
                         help='source cloud')
     parser.add_argument('-t', '--to-cloud', required=True,
                         help='target cloud')
+    parser.add_argument('-j', '--jobs', type=int, default=min(8, (os.cpu_count() or 1) * 2),
+                        help='number of zones to sync in parallel')
+    parser.add_argument('-R', '--requests', type=int, default=32,
+                        help='max. number of record API calls in flight (all zones)')
+    parser.add_argument('-s', '--skip-unchanged', action='store_true',
+                        help='skip zones with unchanged source serial since last sync')
     parser.add_argument('-a', '--all', action='store_true',
                         help='process all found zones')
     parser.add_argument('zones', nargs="*",
@@ -77,14 +145,72 @@ def setup_parser():
     return parser
 
 
+_PARSER = _build_parser()
+
+
+def setup_parser():
+    "Return argument parser (built once at import)"
+    return _PARSER
+
+
+def tune_session(conn, maxsize):
+    """Let conn keep up to maxsize connections per host alive
+       and retry requests on transient errors (not for POST and DELETE:
+       a retried DELETE that already succeeded would fail with 404)
+    """
+    from keystoneauth1.session import TCPKeepAliveAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(total=3, backoff_factor=0.2, status_forcelist=(429, 502, 503, 504),
+                  allowed_methods=Retry.DEFAULT_ALLOWED_METHODS - {'DELETE'},
+                  raise_on_status=False)
+    # keystoneauth's adapter, so we keep its TCP keepalive socket options
+    adapter = TCPKeepAliveAdapter(pool_connections=32, pool_maxsize=maxsize, max_retries=retry)
+    for prefix in ('http://', 'https://'):
+        conn.session.session.mount(prefix, adapter)
+
+
 def get_zones(dnsconn):
-    "Get list of DNS zones from dnsconn cloud DNS service"
-    zones = []
-    for zone in dnsconn.zones():
-        zones.append(zone.name)
+    "Get dict of DNS zones (by name) from dnsconn cloud DNS service"
+    zones = {}
+    for zone in dnsconn.zones(limit=PAGE_SIZE):
+        zones[zone.name] = zone
     return zones
 
 
+def lookup_zone(dnsconn, zones, name):
+    "Find zone name, using the prefetched zones dict if we have one"
+    if zones is not None:
+        return zones.get(name)
+    return dnsconn.find_zone(name)
+
+
+def serial_cache_file():
+    "Name of the file remembering source zone serials from earlier syncs"
+    cachedir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(cachedir, 'dnssync', 'serials.json')
+
+
+def load_serials(fname):
+    "Load remembered zone serials from fname (empty dict if there are none)"
+    try:
+        with open(fname, encoding='utf-8') as fil:
+            return json.load(fil)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_serials(fname, serials):
+    "Store zone serials in fname"
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'w', encoding='utf-8') as fil:
+        json.dump(serials, fil, indent=1, sort_keys=True)
+
+
+def rec_content(rset):
+    "Comparable content of recordset rset (record order does not matter)"
+    return (rset.ttl, rset.description, frozenset(rset.records))
+
+
 def extract_soamail(rec):
     "Transform mail in SOA rec into proper email address"
     if rec[-1] == '.':
@@ -92,139 +218,154 @@ def extract_soamail(rec):
     return rec.replace('.', '@', 1)
 
 
-def find_record(dns, zone, rec):
-    "Find matching record"
-    rset = dns.recordsets(zone, name=rec.name, type=rec.type)
-    if rset:
-        rset = list(rset)
-        if len(rset) == 0:
-            return None
-        if len(rset) != 1:
-            print(f"ERROR: recordset({rec.name}, {rec.type} not unique: {rset}",
-                  file=sys.stderr)
-        assert len(rset) == 1
-        return rset[0]
-    return None
-
-
-def set_equal(set1, set2):
-    "Compare unordered set for equality"
-    for el1 in set1:
-        if el1 not in set2:
-            return False
-    for el2 in set2:
-        if el2 not in set1:
-            return False
-    return True
-
-
-def sync_zone(dns1, dns2, zone, mail, remove, verbose):
+def rec_attrs(rset):
+    "Attributes of recordset rset to pass to create/update_recordset"
+    return {'name': rset.name, 'type': rset.type, 'ttl': rset.ttl,
+            'records': rset.records, 'description': rset.description}
+
+
+def sync_zone(dns1, dns2, zone, mail, remove, verbose, pool, szones=None, tzones=None,
+              serials=None):
     """sync zone from dns1 to dns2,
        cleaning extra records in dns2 is remove is True
        overwriting mail in SOA if passed.
+       zone needs to be passed with trailing '.'.
+       Record changes are submitted to the executor pool.
+       szones/tzones are optional dicts of prefetched zones in dns1/dns2.
+       serials is an optional dict of source zone serials from the last sync;
+       unchanged zones are skipped and it is updated after a clean sync.
+       Returns Stats for this zone.
     """
-    global nodomcreate, noreccreate, norecchange, norecnochg, norecdelete, norecskip
-    # Append trailing '.' if not passed
-    if zone[-1] != '.':
-        zone += '.'
+    import openstack
+    stats = Stats(nodom=1)
     if verbose:
-        print(f"Sync zone {zone}")
-    szone = dns1.find_zone(zone)
+        out(f"Sync zone {zone}")
+    szone = lookup_zone(dns1, szones, zone)
     if not szone:
-        print(f'ERROR: zone {zone} does not exist in src cloud', file=sys.stderr)
-        return 1
-    ssets = dns1.recordsets(szone)
-    zonens = dns1.recordsets(szone, name=zone, type='NS')
+        out(f'ERROR: zone {zone} does not exist in src cloud', file=sys.stderr)
+        stats.errs += 1
+        return stats
+    # Source zone unchanged since last successful sync?
+    if serials is not None and not remove:
+        last = serials.get(zone)
+        if last and last['serial'] == szone.serial:
+            if verbose:
+                out(f"Zone {zone} unchanged (serial {szone.serial}), skipped")
+            stats.norecskip += last['records']
+            return stats
+    # Fetch all recordsets once, indexed by (name, type) for lookups
+    ssets = list(dns1.recordsets(szone, limit=PAGE_SIZE))
+    src_by_key = {(sset.name, sset.type): sset for sset in ssets}
+    # Zone NS and SOA records are part of the recordsets we already have
+    zonens = src_by_key.get((zone, 'NS'))
     if not zonens:
-        print(f'ERROR: zone {zone} has no NS records', file=sys.stderr)
-        return 1
-    zonesoa = dns1.recordsets(szone, name=zone, type='SOA')
+        out(f'ERROR: zone {zone} has no NS records', file=sys.stderr)
+        stats.errs += 1
+        return stats
+    zonesoa = src_by_key.get((zone, 'SOA'))
     if not zonesoa:
-        print(f'EROOR: zone {zone} has no SOA record', file=sys.stderr)
-        return 1
-    srcns = list(zonens)[0].records
-    srcsoa = list(zonesoa)[0].records[0].split(" ")
+        out(f'EROOR: zone {zone} has no SOA record', file=sys.stderr)
+        stats.errs += 1
+        return stats
+    srcns = zonens.records
+    srcsoa = zonesoa.records[0].split(" ")
     if mail:
         soamail = mail
     else:
         # soamail = extract_soamail(srcsoa[1])
         soamail = szone.email
 
-    errs = 0
-    tzone = dns2.find_zone(zone)
+    tzone = lookup_zone(dns2, tzones, zone)
     if not tzone:
-        print(f"DNS create(name={zone}, ttl={srcsoa[4]}, mail={soamail})")
+        out(f"DNS create(name={zone}, ttl={srcsoa[4]}, mail={soamail})")
         try:
             tzone = dns2.create_zone(name=zone, ttl=srcsoa[4], email=soamail,
                                      description=szone.description)
-            nodomcreate += 1
+            stats.nodomcreate += 1
         except openstack.exceptions.SDKException as exc:
-            print(exc, file=sys.stderr)
-            return 1
-
-    dstns = list(dns2.recordsets(tzone, name=zone, type='NS'))[0].records
-    tsets = dns2.recordsets(tzone)
-    # TODO: Check if it's more efficient to collect lists and then iterate over them ...
-    # Forward copy
-    for sset in ssets:
-        # Do not copy NS records for sub domains pointing to one self
+            out(exc, file=sys.stderr)
+            stats.errs += 1
+            return stats
+
+    tsets = list(dns2.recordsets(tzone, limit=PAGE_SIZE))
+    tgt_by_key = {(tset.name, tset.type): tset for tset in tsets}
+    dstzonens = tgt_by_key.get((zone, 'NS'))
+    if not dstzonens:
+        out(f'ERROR: zone {zone} has no NS records in target cloud', file=sys.stderr)
+        stats.errs += 1
+        return stats
+    dstns = dstzonens.records
+    # NS record sets pointing to source or target cloud DNS (unordered)
+    own_ns = (frozenset(srcns), frozenset(dstns))
+    # Collect needed changes first, then submit them to the shared pool
+    creates = []
+    updates = []
+    deletes = []
+    # Single pass over all recordsets in source and/or target
+    last_progress = -PROGRESS_INTERVAL
+    for key in sorted(src_by_key.keys() | tgt_by_key.keys()):
+        sset = src_by_key.get(key)
+        tset = tgt_by_key.get(key)
         if verbose:
-            print(f"\rRecord {sset.name} type {sset.type}                    ", end="")
-        if sset.type == 'NS':
-            if set_equal(sset.records, srcns) or set_equal(sset.records, dstns):
-                norecskip += 1
-                continue
-        # Never overwrite SOA (ignore TTL differences if any)
-        if sset.type == 'SOA':
-            norecskip += 1
+            last_progress = progress(f"Record {key[0]} type {key[1]}", last_progress)
+        # Only in target: remove if requested
+        if sset is None:
+            if remove:
+                deletes.append(tset)
+            continue
+        # Never overwrite SOA (ignore TTL differences if any) and
+        # do not copy NS records for sub domains pointing to one self
+        if sset.type in SKIP_TYPES or (sset.type == 'NS' and frozenset(sset.records) in own_ns):
+            stats.norecskip += 1
             continue
-        # Record already present?
-        tset = find_record(dns2, tzone, sset)
         # FIXME: Do we need to copy over status field as well?
-        if not tset:
+        if tset is None:
+            creates.append(sset)
+        elif rec_content(tset) != rec_content(sset):
+            updates.append((tset, sset))
+        else:
+            stats.norecnochg += 1
+    # Designate has no bulk recordset API, so this is one call per change
+    futures = {}
+    try:
+        for sset in creates:
+            futures[pool.submit(dns2.create_recordset, tzone, **rec_attrs(sset))] = 'create'
+        for tset, sset in updates:
+            futures[pool.submit(dns2.update_recordset, tset, **rec_attrs(sset))] = 'change'
+        for tset in deletes:
+            futures[pool.submit(dns2.delete_recordset, tset)] = 'delete'
+        # Collect results (counters are only touched from this thread).
+        # Not using as_completed(): it does not wake up for cancelled futures.
+        for fut, kind in futures.items():
             try:
-                dns2.create_recordset(tzone, name=sset.name, type=sset.type, ttl=sset.ttl,
-                                      records=sset.records, description=sset.description)
-                noreccreate += 1
+                fut.result()
             except openstack.exceptions.SDKException as exc:
-                print(exc, file=sys.stderr)
-                errs += 1
-        else:
-            if tset.ttl != sset.ttl or tset.records != sset.records or tset.description != sset.description:
-                try:
-                    dns2.update_recordset(tset, name=sset.name, type=sset.type, ttl=sset.ttl,
-                                          records=sset.records, description=sset.description)
-                    norecchange += 1
-                except openstack.exceptions.SDKException as exc:
-                    print(exc, file=sys.stderr)
-                    errs += 1
+                out(exc, file=sys.stderr)
+                stats.errs += 1
+                continue
+            if kind == 'create':
+                stats.noreccreate += 1
+            elif kind == 'change':
+                stats.norecchange += 1
             else:
-                norecnochg += 1
-    # Backward cleanup
-    if remove:
-        for tset in tsets:
-            if verbose:
-                print(f"\rRecord {tset.name} type {tset.type}                    ", end="")
-            sset = find_record(dns1, szone, tset)
-            if not sset:
-                try:
-                    dns2.delete_recordset(tset)
-                    norecdelete += 1
-                except openstack.exceptions.SDKException as exc:
-                    print(exc, file=sys.stderr)
-                    errs += 1
+                stats.norecdelete += 1
+    finally:
+        # Unexpected error or cancellation: drop our queued changes
+        for fut in futures:
+            fut.cancel()
     if verbose:
-        print("\r   \r", end="")
-    return errs
+        out("\r   \r", end="")
+    if serials is not None and not stats.errs:
+        serials[zone] = {'serial': szone.serial, 'records': len(ssets)}
+    return stats
 
 
 def main(argv):
     "Main entry point"
-    global nodom
     if not argv[1:]:
         usage()
     parser = setup_parser()
-    args = parser.parse_args()
+    args = parser.parse_args(argv[1:])
     if not args.zones and not args.all:
         print('ERROR: Must specify zones or --all', file=sys.stderr)
         usage()
@@ -232,29 +373,65 @@ def main(argv):
         print('ERROR: Specify either zones or --all', file=sys.stderr)
         usage()
 
+    import openstack
     cloud1 = openstack.connect(args.from_cloud)
     cloud2 = openstack.connect(args.to_cloud)
+    # One connection for each thread that may talk to the cloud
+    tune_session(cloud1, args.requests + args.jobs)
+    tune_session(cloud2, args.requests + args.jobs)
 
     cloud1.authorize()
     cloud2.authorize()
 
+    # With --all, list the zones of both clouds once instead of looking
+    # up every zone individually
     if args.all:
-        zones = get_zones(cloud1.dns)
+        szones = get_zones(cloud1.dns)
+        tzones = get_zones(cloud2.dns)
+        zones = list(szones)
     else:
-        zones = args.zones
-
-    errs = 0
-    for zone in zones:
-        errs += sync_zone(cloud1.dns, cloud2.dns, zone, args.mail, args.remove, args.verbose)
-        nodom += 1
+        szones = None
+        tzones = None
+        # Append trailing '.' if not passed
+        zones = [zone if zone[-1] == '.' else zone + '.' for zone in args.zones]
+
+    # Source zone serials from earlier syncs to the same target
+    if args.skip_unchanged:
+        serialfile = serial_cache_file()
+        allserials = load_serials(serialfile)
+        serials = allserials.setdefault(f"{args.from_cloud}>{args.to_cloud}", {})
+    else:
+        serials = None
+
+    stats = Stats()
+    # Zones are synced in parallel, their record changes share one bounded
+    # pool, so the number of requests in flight does not grow with --jobs
+    with ThreadPoolExecutor(max_workers=max(1, args.requests)) as recpool, \
+         ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(sync_zone, cloud1.dns, cloud2.dns, zone,
+                               args.mail, args.remove, args.verbose, recpool,
+                               szones, tzones, serials)
+                   for zone in zones]
+        try:
+            for fut in as_completed(futures):
+                stats += fut.result()
+        except BaseException:
+            # Ctrl-C or unexpected error: do not start any further zones
+            # or record changes before passing the exception on
+            pool.shutdown(wait=False, cancel_futures=True)
+            recpool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    if serials is not None:
+        try:
+            save_serials(serialfile, allserials)
+        except OSError as exc:
+            print(f"ERROR: saving {serialfile}: {exc}", file=sys.stderr)
 
     if not args.quiet:
-        print(f"Statistics: {nodom} domains processed, {nodomcreate} domains created")
-        print(f"            {noreccreate} records created, {norecdelete} records deleted")
-        print(f"            {norecchange} records changed, {norecnochg} records unchanged, {norecskip} records skipped")
-        print(f"{errs} errors")
+        stats.report()
 
-    return errs
+    return stats.errs
 
 
 # Call main if used alone